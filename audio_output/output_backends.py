@@ -0,0 +1,165 @@
+import os
+import threading
+import time
+import wave
+
+import numpy as np
+
+
+# Every backend exposes open_stream(render_block, rate, channels, frames_per_buffer) and hands back a stream with
+# stop_stream() and close(), mirroring the subset of the PyAudio stream API that the runner uses. render_block()
+# returns one float32 block of frames_per_buffer * channels samples.
+
+
+class PyAudioBackend:
+    def __init__(self):
+        self._pyaudio = None
+
+    def open_stream(self, render_block, rate, channels=1, frames_per_buffer=1024):
+        import pyaudio
+
+        if self._pyaudio is None:
+            self._pyaudio = pyaudio.PyAudio()
+
+        def callback(_in_data, _frame_count, _time_info, _status):
+            return render_block(), pyaudio.paContinue
+
+        return self._pyaudio.open(format=pyaudio.paFloat32, channels=channels, rate=int(rate), output=True,
+                                  frames_per_buffer=frames_per_buffer, stream_callback=callback)
+
+
+class BlockStream:
+    def __init__(self, render_block, sink, rate, frames_per_buffer, realtime):
+        self.render_block = render_block
+        self.sink = sink
+        self.block_duration = frames_per_buffer / float(rate)
+        self.realtime = realtime
+
+        self.blocks = 0
+        self.render_time = 0.0
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        next_block = time.perf_counter()
+        while not self._stop.is_set():
+            start = time.perf_counter()
+            block = self.render_block()
+            self.render_time += time.perf_counter() - start
+            self.sink.write(block)
+            self.blocks += 1
+
+            if self.realtime:
+                next_block += self.block_duration
+                delay = next_block - time.perf_counter()
+                if delay > 0:
+                    self._stop.wait(delay)
+
+    def stop_stream(self):
+        self._stop.set()
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+
+    def close(self):
+        self.stop_stream()
+        self.sink.close()
+
+
+class BlockSinkBackend:
+    def __init__(self, sink_factory, realtime=True):
+        # sink_factory(rate, channels, index) opens the sink for the index-th stream opened on this backend.
+        self.sink_factory = sink_factory
+        self.realtime = realtime
+        self.streams = []
+
+    def open_stream(self, render_block, rate, channels=1, frames_per_buffer=1024):
+        sink = self.sink_factory(rate, channels, len(self.streams))
+        stream = BlockStream(render_block, sink, rate, frames_per_buffer, self.realtime)
+        self.streams.append(stream)
+        return stream
+
+
+class NullSink:
+    def write(self, block):
+        pass
+
+    def close(self):
+        pass
+
+
+class NullBackend(BlockSinkBackend):
+    def __init__(self, realtime=True):
+        super().__init__(lambda rate, channels, index: NullSink(), realtime=realtime)
+
+
+class WavSink:
+    def __init__(self, path, rate, channels):
+        self.file = wave.open(path, 'wb')
+        self.file.setnchannels(channels)
+        self.file.setsampwidth(2)
+        self.file.setframerate(int(rate))
+
+    def write(self, block):
+        self.file.writeframes((np.clip(block, -1.0, 1.0) * 32767.0).astype('<i2').tobytes())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class WavFileBackend(BlockSinkBackend):
+    def __init__(self, path, realtime=True):
+        super().__init__(self.open_wav_sink, realtime=realtime)
+        self.path = path
+
+    def open_wav_sink(self, rate, channels, index):
+        # Each stream gets its own file, so concurrent streams don't clobber each other.
+        path = self.path
+        if index > 0:
+            root, ext = os.path.splitext(self.path)
+            path = '{}-{}{}'.format(root, index, ext)
+        return WavSink(path, rate, channels)
+
+
+class MemorySink:
+    def __init__(self, channels):
+        self.channels = channels
+        self.blocks = []
+
+    def write(self, block):
+        self.blocks.append(np.array(block, dtype=np.float32, copy=True))
+
+    def close(self):
+        pass
+
+    @property
+    def samples(self):
+        if len(self.blocks) == 0:
+            return np.zeros((0, self.channels), dtype=np.float32)
+        return np.concatenate(self.blocks).reshape(-1, self.channels)
+
+
+class MemoryBackend(BlockSinkBackend):
+    def __init__(self, realtime=True):
+        super().__init__(lambda rate, channels, index: MemorySink(channels), realtime=realtime)
+
+
+def make_output_backend(spec):
+    # Specs: 'pyaudio', 'null', 'wav:<path>', 'memory'. The main mixer keeps its stream open for the whole session, so
+    # only real-time backends are offered here; non-real-time ones would render silence as fast as they could for as
+    # long as it ran. Bounded renders (e.g. benchmarks) construct those backends directly with realtime=False.
+    name, _, arg = spec.partition(':')
+
+    if name == 'pyaudio':
+        return PyAudioBackend()
+    elif name == 'null' and arg == '':
+        return NullBackend()
+    elif name == 'wav':
+        return WavFileBackend(arg if arg else 'output.wav')
+    elif name == 'memory' and arg == '':
+        return MemoryBackend()
+
+    raise ValueError('Unknown output backend: {}'.format(spec))
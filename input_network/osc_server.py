@@ -0,0 +1,134 @@
+import asyncio
+import struct
+import time
+
+
+GATE_THRESHOLD = 0.01
+MAX_MESSAGES_PER_SENDER = 4096  # Mapped messages accepted from one sender per block
+MAX_QUEUED_TRANSITIONS = 8  # Gate transitions queued per slot
+DROP_REPORT_INTERVAL = 1.0
+
+
+def read_string(data, offset):
+    end = data.index(b'\0', offset)
+    return data[offset:end].decode('utf-8', 'replace'), (end + 4) & ~3
+
+
+def parse_packet(data, messages):
+    # Appends (address, value) for every OSC message in the packet, descending into bundles. Only the first argument
+    # of a message is used, since every control is a single float.
+    if data.startswith(b'#bundle\0'):
+        offset = 16  # '#bundle\0' and the 8-byte time tag
+        while offset + 4 <= len(data):
+            size = struct.unpack_from('>i', data, offset)[0]
+            parse_packet(data[offset + 4:offset + 4 + size], messages)
+            offset += 4 + size
+        return messages
+
+    address, offset = read_string(data, 0)
+    if offset >= len(data):
+        return messages
+    tags, offset = read_string(data, offset)
+
+    tag = tags[1:2]
+    if tag == 'f':
+        value = struct.unpack_from('>f', data, offset)[0]
+    elif tag == 'd':
+        value = struct.unpack_from('>d', data, offset)[0]
+    elif tag == 'i':
+        value = float(struct.unpack_from('>i', data, offset)[0])
+    elif tag == 'h':
+        value = float(struct.unpack_from('>q', data, offset)[0])
+    elif tag in ('T', 'F'):
+        value = 1.0 if tag == 'T' else 0.0
+    else:
+        return messages
+
+    messages.append((address, value))
+    return messages
+
+
+class ControlBatcher(asyncio.DatagramProtocol):
+    def __init__(self, control_slots, input_count):
+        self.control_slots = control_slots
+        self.input_count = input_count
+
+        # Per slot, a short queue of values still to be written, one per flush. Moves that don't cross the gate
+        # threshold replace the newest entry, while gate transitions are queued behind it, so rapid taps survive
+        # batching and memory stays bounded by the number of controls however fast messages come.
+        self.pending = {}
+        self.messages = {}
+        self.dropped = 0
+        self.last_report = time.monotonic()
+
+    def slot(self, address):
+        name = address.strip('/')
+        if name in self.control_slots:
+            return self.control_slots[name]
+
+        prefix, _, number = name.partition('/')
+        if prefix == 'input' and number.isdigit() and 1 <= int(number) <= self.input_count:
+            return int(number)
+        return None
+
+    def datagram_received(self, data, addr):
+        try:
+            messages = parse_packet(data, [])
+        except (ValueError, struct.error):
+            return
+
+        for address, value in messages:
+            slot = self.slot(address)
+            if slot is None:
+                continue
+
+            # Each sender gets its own per-block budget, so one noisy controller can't starve the others.
+            count = self.messages.get(addr, 0)
+            if count >= MAX_MESSAGES_PER_SENDER:
+                self.dropped += 1
+                continue
+            self.messages[addr] = count + 1
+
+            values = self.pending.setdefault(slot, [])
+            if len(values) > 0 and (values[-1] >= GATE_THRESHOLD) == (value >= GATE_THRESHOLD):
+                values[-1] = value
+            elif len(values) < MAX_QUEUED_TRANSITIONS:
+                values.append(value)
+            else:
+                self.dropped += 1
+
+    def flush(self, inputs):
+        self.messages = {}
+
+        for slot in list(self.pending):
+            values = self.pending[slot]
+            inputs[slot - 1] = values.pop(0)
+            if len(values) == 0:
+                del self.pending[slot]
+
+        if self.dropped > 0 and time.monotonic() - self.last_report >= DROP_REPORT_INTERVAL:
+            print('OSC: dropped {} control messages'.format(self.dropped))
+            self.dropped = 0
+            self.last_report = time.monotonic()
+
+
+async def serve(inputs, qt, control_slots, host, port, block_duration):
+    loop = asyncio.get_event_loop()
+    transport, batcher = await loop.create_datagram_endpoint(
+        lambda: ControlBatcher(control_slots, len(inputs)),
+        local_addr=(host, port)
+    )
+
+    try:
+        while not qt.value:
+            await asyncio.sleep(block_duration)
+            batcher.flush(inputs)
+    finally:
+        transport.close()
+
+
+def osc_monitor(inputs, qt, control_slots, host='127.0.0.1', port=9000, block_duration=1024 / 19200.0):
+    try:
+        asyncio.run(serve(inputs, qt, control_slots, host, port, block_duration))
+    except OSError as e:
+        print('Could not start OSC server on {}:{}: {}'.format(host, port, e))
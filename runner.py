@@ -3,19 +3,44 @@
 import math
 import numpy as np
 import time
-import random
 import multiprocessing
+import os
 import pygraphviz as pgv
 import sys
 import re
+import threading
 
+from scipy.signal import lfilter, lfiltic
+
+from audio_output.output_backends import make_output_backend, NullBackend
 from input_buttons.input_reader import input_monitor
+from input_network.osc_server import osc_monitor
+from sample_player.sample_library import Sample, SampleLibrary
+from visualization.previews import PreviewWorker, draw_graph, draw_waveform, temp_preview_path
 
 
 SAMPLE_RATE = 19200.0
 VOLUME = 0.5
 FRAME_SIZE = 1024
 
+OUTPUT_CHANNELS = int(os.environ.get('PATCH_CABLE_CHANNELS', '2'))
+
+# Bus 0 pans across every output channel; bus n > 0 feeds output channel n - 1 (one speaker) alone.
+MAIN_BUS = 0
+OUTPUT_BUSES = dict([(MAIN_BUS, list(range(OUTPUT_CHANNELS)))] +
+                    [(c + 1, [c]) for c in range(OUTPUT_CHANNELS)])
+
+# pyaudio, null, wav:<path> or memory
+OUTPUT_BACKEND = os.environ.get('PATCH_CABLE_OUTPUT', 'pyaudio')
+
+# Every .wav file in SAMPLE_DIRECTORY is resampled to SAMPLE_RATE once, cached, and memory-mapped at startup.
+SAMPLE_DIRECTORY = os.environ.get('PATCH_CABLE_SAMPLES')
+SAMPLE_CACHE_DIRECTORY = os.environ.get('PATCH_CABLE_SAMPLE_CACHE', '.sample_cache')
+SAMPLE_STREAM_CHUNK = FRAME_SIZE * 8
+
+# host:port of the OSC/UDP control server, or 'off'
+OSC_ADDRESS = os.environ.get('PATCH_CABLE_OSC', '127.0.0.1:9000')
+
 BEAT_32ND = SAMPLE_RATE / 32.0
 BEAT_16TH = SAMPLE_RATE / 16.0
 BEAT_8TH = SAMPLE_RATE / 8.0
@@ -23,6 +48,11 @@ BEAT_4TH = SAMPLE_RATE / 4.0
 BEAT_HALF = SAMPLE_RATE / 2.0
 BEAT_WHOLE = SAMPLE_RATE
 
+# Once its envelopes have released, a chain keeps playing until its output falls below TAIL_THRESHOLD (so delay and
+# reverb tails ring out) or until MAX_TAIL samples have passed.
+TAIL_THRESHOLD = 1e-4
+MAX_TAIL = BEAT_WHOLE * 4
+
 BUTTON_1 = 1
 BUTTON_2 = 2
 BUTTON_3 = 3
@@ -34,14 +64,53 @@ POTENTIOMETER = 8
 
 TWO_PI = 2.0 * math.pi
 
+block_offsets = np.arange(1, FRAME_SIZE + 1)  # Sample indices within a block; a chain's first sample is x = 1
+
 
 global_watchers = []
 
+graph_version = 0  # Bumped on every graph edit; keys the cached chain layouts
+
 quit_threads = multiprocessing.Value('i', 0)
 
 manager = multiprocessing.Manager()
 shared_list = manager.list(([0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]))
 
+# Named controls for the OSC server, mapped to (1-based) shared_list slots; the serial inputs are pre-named.
+control_slots = dict([('button/{}'.format(b), b) for b in range(BUTTON_1, BUTTON_7 + 1)] +
+                     [('potentiometer', POTENTIOMETER)])
+
+
+def control_slot(name):
+    # Controls have to be declared before the input processes start, so that every process sees the same slots.
+    name = name.strip('/')
+    if name not in control_slots:
+        shared_list.append(0.0)
+        control_slots[name] = len(shared_list)
+    return control_slots[name]
+
+output_backend = make_output_backend(OUTPUT_BACKEND)
+preview_worker = PreviewWorker()
+
+sample_library = SampleLibrary(SAMPLE_CACHE_DIRECTORY, SAMPLE_RATE, SAMPLE_STREAM_CHUNK)
+if SAMPLE_DIRECTORY is not None:
+    sample_library.load_directory(SAMPLE_DIRECTORY)
+
+
+def pan_gains(pan, channels):
+    # Equal-power pan from -1.0 (first channel) to 1.0 (last channel) across a line of speakers.
+    gains = np.zeros(channels, dtype=np.float32)
+    if channels == 1:
+        gains[0] = 1.0
+        return gains
+
+    position = (min(max(pan, -1.0), 1.0) + 1.0) / 2.0 * (channels - 1)
+    left = min(int(position), channels - 2)
+    fraction = position - left
+    gains[left] = math.cos(fraction * math.pi / 2.0)
+    gains[left + 1] = math.sin(fraction * math.pi / 2.0)
+    return gains
+
 
 class Parameter:
     PARAM_CONSTANT = 'PARAM_CONSTANT'
@@ -49,6 +118,9 @@ class Parameter:
     PARAM_INPUT = 'PARAM_INPUT'
 
     def __init__(self, param_value):
+        if isinstance(param_value, str):
+            param_value = control_slot(param_value)
+
         self.param_value = param_value
 
         if type(param_value).__name__ == 'Chain':
@@ -90,15 +162,22 @@ class Node:
         self.downstream = []
         self.function = self.id
         self.value = self.function(0)
+        self.block = np.zeros(FRAME_SIZE, dtype=np.float32)
 
     def register_upstream(self, up):
+        global graph_version
+        graph_version += 1
+
         self.upstream.append(up)
         self.upstream_count = len(self.upstream)
         up.attach_downstream(self)
         return self
 
     def unregister_upstream(self, up):
+        global graph_version
+
         if up in self.upstream:
+            graph_version += 1
             self.upstream.remove(up)
             self.upstream_count = len(self.upstream)
             up.remove_downstream(self)
@@ -115,16 +194,23 @@ class Node:
         ds.register_upstream(self)
         return self
 
-    def step(self):
-        self.value = self.function(sum([up.value for up in self.upstream]) / self.upstream_count)
+    def input_block(self, frames):
+        if self.upstream_count == 0:
+            return np.zeros(frames, dtype=np.float32)
+        elif self.upstream_count == 1:
+            return self.upstream[0].block[:frames]
+        return sum(up.block[:frames] for up in self.upstream) / self.upstream_count
 
-    def run_chain(self):
-        self.step()
-        for ds in self.downstream:
-            ds.run_chain()
+    def set_block(self, block, frames):
+        self.block = np.broadcast_to(np.asarray(block, dtype=np.float32), (frames,))
+        self.value = self.block[-1]
+
+    def process_block(self, frames):
+        self.set_block(self.function(self.input_block(frames)), frames)
 
     def reset_chain(self):
         self.value = self.function(0)
+        self.block = np.zeros(FRAME_SIZE, dtype=np.float32)
         for ds in self.downstream:
             ds.reset_chain()
 
@@ -137,9 +223,11 @@ class SourceNode(Node):
         super().__init__()
         self._x = 0
 
-    def step(self):
-        self._x += 1
-        self.value = self.function(self._x)
+    def process_block(self, frames):
+        # Sources ignore their upstream values; the functions are evaluated over the block's sample indices.
+        xs = self._x + block_offsets[:frames]
+        self._x += frames
+        self.set_block(self.function(xs), frames)
 
     def reset_chain(self):
         self._x = 0
@@ -160,7 +248,7 @@ class ChainStartNode(SourceNode):
 
     def tick(self):
         if self.chain is not None:
-            if self.start_param.value >= self.gate and not self.chain.started:
+            if self.start_param.value >= self.gate and (not self.chain.started or self.chain.terminating):
                 self.chain.play_chain()
             elif self.start_param.value < self.gate and self.chain.started and not self.chain.terminating:
                 self.chain.stop_chain()
@@ -174,14 +262,24 @@ class ChainStartNode(SourceNode):
 
 
 class ChainTerminationNode(Node):
-    def __init__(self, release_chain=None):
+    def __init__(self, pan=0.0, bus=MAIN_BUS):
         super().__init__()
-        self.release_chain = release_chain
+        self.bus = bus
+        self.pan = pan
+        self.output_gains = pan_gains(pan, len(OUTPUT_BUSES[bus]))
+
+    def set_pan(self, pan):
+        self.pan = pan
+        self.output_gains = pan_gains(pan, len(OUTPUT_BUSES[self.bus]))
+        return self
+
+    def get_display_properties(self):
+        return 'Pan: {}\nBus: {}'.format(self.pan, self.bus)
 
 
 class RandomNoiseNode(SourceNode):
-    def noise_fn(self, _):
-        return self.translate - 1.0 + random.random() * self.amplitude * 2.0
+    def noise_fn(self, x):
+        return self.translate - 1.0 + np.random.random(np.shape(x)) * self.amplitude * 2.0
 
     def __init__(self, translate=0.0, amplitude=1.0):
         super().__init__()
@@ -195,9 +293,9 @@ class RandomNoiseNode(SourceNode):
 
 class SineNode(SourceNode):
     def sin(self, x):
-        return self.translate + self.amplitude * math.sin(TWO_PI * (x / SAMPLE_RATE)
-                                                          * (self.frequency_offset + self.frequency.cached_value
-                                                             * self.frequency_mulitplier))
+        return self.translate + self.amplitude * np.sin(TWO_PI * (x / SAMPLE_RATE)
+                                                        * (self.frequency_offset + self.frequency.cached_value
+                                                           * self.frequency_mulitplier))
 
     def __init__(
             self,
@@ -227,7 +325,7 @@ class SineNode(SourceNode):
 
 class SquareNode(SourceNode):
     def square(self, x):
-        return math.copysign(1, math.sin(TWO_PI * (x / SAMPLE_RATE) * self.frequency.value))
+        return np.copysign(1, np.sin(TWO_PI * (x / SAMPLE_RATE) * self.frequency.value))
 
     def __init__(self, frequency=Parameter(440.0)):
         super().__init__()
@@ -243,7 +341,7 @@ class SquareNode(SourceNode):
 class TriangleNode(SourceNode):
     def triangle(self, x):
         return self.translate + self.amplitude * (2 / math.pi)\
-               * math.asin(math.sin(TWO_PI * (x / SAMPLE_RATE) * self.frequency.value))
+               * np.arcsin(np.sin(TWO_PI * (x / SAMPLE_RATE) * self.frequency.value))
 
     def __init__(self, frequency=Parameter(440.0), amplitude=1.0, translate=0.0):
         super().__init__()
@@ -262,12 +360,15 @@ class TriangleNode(SourceNode):
 
 class KickDrumNode(SourceNode):  # kick drum
     def kick_drum(self, x):
-        if 0 < x < self.length:
-            return self.translate + random.random() * self.amplitude
-        elif self.length <= x < self.length + self.sustain:
-            return self.amplitude * math.sin(TWO_PI * (x / SAMPLE_RATE) * self.frequency.value)
-        else:
-            return 0
+        return np.where(
+            (0 < x) & (x < self.length),
+            self.translate + np.random.random(np.shape(x)) * self.amplitude,
+            np.where(
+                (self.length <= x) & (x < self.length + self.sustain),
+                self.amplitude * np.sin(TWO_PI * (x / SAMPLE_RATE) * self.frequency.value),
+                0
+            )
+        )
 
     def __init__(
             self,
@@ -291,10 +392,11 @@ class KickDrumNode(SourceNode):  # kick drum
 
 class HiHatNode(SourceNode):  # hi-hat
     def hi_hat(self, x):
-        if x < self.length:
-            return self.translate + random.uniform(self.pass_filter, 1.0) * self.amplitude
-        else:
-            return 0
+        return np.where(
+            x < self.length,
+            self.translate + np.random.uniform(self.pass_filter, 1.0, np.shape(x)) * self.amplitude,
+            0
+        )
 
     def __init__(
             self,
@@ -313,13 +415,13 @@ class HiHatNode(SourceNode):  # hi-hat
 
 class SawtoothNode(SourceNode):
     def sawtooth(self, x):
-        try:
-            evaluation = self.amplitude * (-2.0 / math.pi *
-                                           math.atan(1.0/math.tan(
-                                               self.phase + x * math.pi / (SAMPLE_RATE / self.frequency.value))))
-        except ZeroDivisionError:
-            evaluation = 0
-        return evaluation
+        if self.frequency.value == 0:
+            return np.zeros(np.shape(x))
+
+        tangent = np.tan(self.phase + x * math.pi / (SAMPLE_RATE / self.frequency.value))
+        with np.errstate(divide='ignore'):
+            evaluation = self.amplitude * (-2.0 / math.pi * np.arctan(1.0 / tangent))
+        return np.where(tangent == 0, 0, evaluation)
 
     def __init__(self, frequency=Parameter(440.0), amplitude=1.0, phase=0.0):
         super().__init__()
@@ -338,7 +440,7 @@ class SawtoothNode(SourceNode):
 
 class BeatNode(SourceNode):
     def beat_fn(self, x):
-        return self.translate + (self.amplitude if x % self.period_length <= self.beat_length else 0)
+        return self.translate + np.where(x % self.period_length <= self.beat_length, self.amplitude, 0)
 
     def __init__(
             self,
@@ -358,6 +460,50 @@ class BeatNode(SourceNode):
         self.function = self.beat_fn
 
 
+class SampleNode(SourceNode):
+    def __init__(self, sample, amplitude=1.0):
+        super().__init__()
+        self.sample = sample if isinstance(sample, Sample) else sample_library[sample]
+        self.sample.add_voice()
+        self.amplitude = amplitude
+        self._held = None  # Position whose chunk window this voice holds resident
+
+    def hold(self, position):
+        # Takes the new window before letting go of the old one, so the chunks they share are never unheld.
+        if position is not None:
+            self.sample.acquire(position)
+        if self._held is not None:
+            self.sample.release(self._held)
+        self._held = position
+
+    def process_block(self, frames):
+        start = self._x
+        self._x += frames
+
+        chunk = self.sample.stream_chunk
+        if self._held is None or self._held // chunk != start // chunk:
+            self.hold(start)
+
+        block = self.sample.frames(start, frames)
+        if len(block) < frames:
+            block = np.concatenate((block, np.zeros(frames - len(block), dtype=np.float32)))
+        if self.amplitude != 1.0:
+            block = block * self.amplitude
+
+        self.set_block(block, frames)
+
+    def reset_chain(self):
+        self.hold(None)
+        super().reset_chain()
+
+    def get_display_properties(self):
+        return 'Sample: {}\nLength: {} s\nAmplitude: {}'.format(
+            self.sample.name,
+            len(self.sample) / SAMPLE_RATE,
+            self.amplitude
+        )
+
+
 class FilterNode(Node):
     def filter_fn(self, x):
         return self.offset + (x * self.filter_param.value * self.multiplier)
@@ -373,20 +519,23 @@ class FilterNode(Node):
 
 class LinearAttackNode(Node):
     def attack_fn(self, y):
-        return (1 - (max(self.duration - self._x, 0) / self.duration)) * y
+        return (1 - (np.maximum(self.duration - self._xs, 0) / self.duration)) * y
 
     def __init__(self, duration=BEAT_HALF):
         super().__init__()
         self.duration = duration
         self.function = self.attack_fn
         self._x = 0
+        self._xs = 0
 
-    def step(self):
-        self._x += 1
-        super().step()
+    def process_block(self, frames):
+        self._xs = self._x + block_offsets[:frames]
+        self._x += frames
+        super().process_block(frames)
 
     def reset_chain(self):
         self._x = 0
+        self._xs = 0
         super().reset_chain()
 
     def get_display_properties(self):
@@ -397,20 +546,23 @@ class LinearAttackNode(Node):
 
 class LinearDecayNode(Node):
     def decay_fn(self, y):
-        return (max(self.duration - self._x, 0) / self.duration) * y
+        return (np.maximum(self.duration - self._xs, 0) / self.duration) * y
 
     def __init__(self, duration=BEAT_HALF):
         super().__init__()
         self.duration = duration
         self.function = self.decay_fn
         self._x = 0
+        self._xs = 0
 
-    def step(self):
-        self._x += 1
-        super().step()
+    def process_block(self, frames):
+        self._xs = self._x + block_offsets[:frames]
+        self._x += frames
+        super().process_block(frames)
 
     def reset_chain(self):
         self._x = 0
+        self._xs = 0
         super().reset_chain()
 
     def get_display_properties(self):
@@ -419,7 +571,308 @@ class LinearDecayNode(Node):
         )
 
 
-cached_repeat = range(FRAME_SIZE)
+class EnvelopeNode(Node):
+    LINEAR = 'LINEAR'
+    EXPONENTIAL = 'EXPONENTIAL'
+
+    EXPONENTIAL_CURVATURE = 5.0
+
+    def __init__(self, gate_segments, release_segments, curve=LINEAR):
+        # Segments are (target level, length in samples) pairs. The gate-on segments run in order and then hold their
+        # last level until the gate closes; the release segments then run from wherever the level is at that point.
+        # Lengths are rounded to whole samples, since the renderer advances through segments a sample at a time.
+        super().__init__()
+        self.gate_segments = [(level, int(round(length))) for level, length in gate_segments]
+        self.release_segments = [(level, int(round(length))) for level, length in release_segments]
+        self.curve = curve
+
+        self._gate_request = False  # Only written by the scheduler (gate_on / gate_off)
+        self._gate = False  # The audio thread's view of the gate; everything below is only touched while rendering
+        self._segments = release_segments
+        self._segment = len(release_segments)
+        self._position = 0
+        self._start_level = 0.0
+        self._level = 0.0
+
+    def gate_on(self):
+        self._gate_request = True
+
+    def gate_off(self):
+        self._gate_request = False
+
+    @property
+    def finished(self):
+        return not self._gate_request and not self._gate and self._segment >= len(self._segments)
+
+    def shape(self, start, target, t):
+        if self.curve == EnvelopeNode.EXPONENTIAL:
+            k = EnvelopeNode.EXPONENTIAL_CURVATURE
+            t = (1.0 - np.exp(-k * t)) / (1.0 - math.exp(-k))
+        return start + (target - start) * t
+
+    def envelope_block(self, frames):
+        gate = self._gate_request
+        if gate != self._gate:
+            self._gate = gate
+            self._segments = self.gate_segments if gate else self.release_segments
+            self._segment = 0
+            self._position = 0
+            self._start_level = self._level
+
+        envelope = np.empty(frames)
+        filled = 0
+        while filled < frames:
+            if self._segment >= len(self._segments):
+                envelope[filled:] = self._level
+                break
+
+            target, length = self._segments[self._segment]
+            n = int(min(frames - filled, max(length - self._position, 0)))
+            if n > 0:
+                t = (self._position + block_offsets[:n]) / length
+                envelope[filled:filled + n] = self.shape(self._start_level, target, t)
+                self._level = envelope[filled + n - 1]
+                filled += n
+                self._position += n
+
+            if self._position >= length:
+                self._level = target
+                self._start_level = target
+                self._segment += 1
+                self._position = 0
+
+        return envelope
+
+    def process_block(self, frames):
+        self.set_block(self.envelope_block(frames) * self.input_block(frames), frames)
+
+    def reset_chain(self):
+        self._gate_request = False
+        self._gate = False
+        self._segments = self.release_segments
+        self._segment = len(self.release_segments)
+        self._position = 0
+        self._start_level = 0.0
+        self._level = 0.0
+        super().reset_chain()
+
+    def get_display_properties(self):
+        return 'Curve: {}\nGate: {}\nRelease: {}'.format(
+            self.curve,
+            ', '.join('{} in {} s'.format(level, length / SAMPLE_RATE) for level, length in self.gate_segments),
+            ', '.join('{} in {} s'.format(level, length / SAMPLE_RATE) for level, length in self.release_segments)
+        )
+
+
+class ADSRNode(EnvelopeNode):
+    def __init__(self, attack=BEAT_32ND, decay=BEAT_16TH, sustain=0.8, release=BEAT_8TH, curve=EnvelopeNode.LINEAR):
+        super().__init__([(1.0, attack), (sustain, decay)], [(0.0, release)], curve=curve)
+        self.attack = attack
+        self.decay = decay
+        self.sustain = sustain
+        self.release = release
+
+    def get_display_properties(self):
+        return 'Curve: {}\nA: {} s\nD: {} s\nS: {}\nR: {} s'.format(
+            self.curve,
+            self.attack / SAMPLE_RATE,
+            self.decay / SAMPLE_RATE,
+            self.sustain,
+            self.release / SAMPLE_RATE
+        )
+
+
+class DelayLine:
+    MAX_CHUNKS = 8
+
+    def __init__(self, size):
+        self.buffer = np.zeros(size, dtype=np.float32)
+        self.size = size
+        self.position = 0
+
+    def process(self, x, delay, feedback):
+        # Runs the feedback comb w[n] = x[n] + feedback * w[n - delay] and returns (w, w delayed by `delay`). Blocks
+        # are split into chunks no longer than the delay, so every delayed sample read is already in the buffer. Short
+        # delays with feedback would need many chunks, so they run the recursion through lfilter instead, seeded from
+        # the buffer; its cost grows with the delay, which is why longer delays stay chunked.
+        delay = int(min(max(delay, 1), self.size))
+        n = len(x)
+
+        if feedback == 0.0 and delay < n:
+            written = np.asarray(x, dtype=np.float32)
+            history = self.buffer[(self.position - delay + np.arange(delay)) % self.size]
+            delayed = np.concatenate((history, written[:n - delay]))
+            self.write(written)
+            return written, delayed
+
+        if feedback != 0.0 and delay * DelayLine.MAX_CHUNKS < n:
+            a = np.zeros(delay + 1)
+            a[0] = 1.0
+            a[delay] = -feedback
+            past = self.buffer[(self.position - 1 - np.arange(delay)) % self.size]
+            history = past[::-1]
+            written, _ = lfilter([1.0], a, x, zi=lfiltic([1.0], a, past))
+            delayed = np.concatenate((history, written[:n - delay]))
+            self.write(written)
+            return written, delayed
+
+        written = np.empty(n, dtype=np.float32)
+        delayed = np.empty(n, dtype=np.float32)
+        for start in range(0, n, delay):
+            stop = min(start + delay, n)
+            delayed[start:stop] = self.buffer[(self.position - delay + np.arange(stop - start)) % self.size]
+            written[start:stop] = x[start:stop] + feedback * delayed[start:stop]
+            self.write(written[start:stop])
+        return written, delayed
+
+    def write(self, values):
+        self.buffer[(self.position + np.arange(len(values))) % self.size] = values
+        self.position = (self.position + len(values)) % self.size
+
+    def reset(self):
+        self.buffer.fill(0.0)
+        self.position = 0
+
+
+class BiquadFilterNode(Node):
+    LOWPASS = 'LOWPASS'
+    HIGHPASS = 'HIGHPASS'
+    BANDPASS = 'BANDPASS'
+
+    def __init__(
+            self,
+            mode=LOWPASS,
+            cutoff=Parameter(1000.0),
+            q=Parameter(0.707),
+            cutoff_multiplier=1.0,
+            cutoff_offset=0.0
+    ):
+        super().__init__()
+        self.mode = mode
+        self.cutoff = cutoff
+        self.q = q
+        self.cutoff_multiplier = cutoff_multiplier
+        self.cutoff_offset = cutoff_offset
+
+        self._coefficients_key = None
+        self._b = None
+        self._a = None
+        self._zi = np.zeros(2)
+
+    def update_coefficients(self):
+        cutoff = min(max(self.cutoff_offset + self.cutoff.cached_value * self.cutoff_multiplier, 10.0),
+                     0.49 * SAMPLE_RATE)
+        q = max(self.q.cached_value, 0.01)
+
+        # Coefficients (RBJ cookbook) are only recalculated when a parameter has actually moved.
+        if self._coefficients_key == (cutoff, q):
+            return
+        self._coefficients_key = (cutoff, q)
+
+        w0 = TWO_PI * cutoff / SAMPLE_RATE
+        cos_w0 = math.cos(w0)
+        alpha = math.sin(w0) / (2.0 * q)
+
+        if self.mode == BiquadFilterNode.HIGHPASS:
+            b = [(1.0 + cos_w0) / 2.0, -(1.0 + cos_w0), (1.0 + cos_w0) / 2.0]
+        elif self.mode == BiquadFilterNode.BANDPASS:
+            b = [alpha, 0.0, -alpha]
+        else:
+            b = [(1.0 - cos_w0) / 2.0, 1.0 - cos_w0, (1.0 - cos_w0) / 2.0]
+        a = [1.0 + alpha, -2.0 * cos_w0, 1.0 - alpha]
+
+        self._b = np.array(b) / a[0]
+        self._a = np.array(a) / a[0]
+
+    def process_block(self, frames):
+        self.update_coefficients()
+        block, self._zi = lfilter(self._b, self._a, self.input_block(frames), zi=self._zi)
+        self.set_block(block, frames)
+
+    def reset_chain(self):
+        self._zi = np.zeros(2)
+        super().reset_chain()
+
+    def get_display_properties(self):
+        return 'Mode: {}\nCutoff: {} + {} * {}\nQ: {}'.format(
+            self.mode,
+            self.cutoff_offset,
+            self.cutoff.cached_value,
+            self.cutoff_multiplier,
+            self.q.cached_value
+        )
+
+
+class DelayNode(Node):
+    def __init__(
+            self,
+            delay=Parameter(BEAT_8TH),
+            feedback=Parameter(0.5),
+            mix=Parameter(0.5),
+            delay_multiplier=1.0,
+            max_delay=BEAT_WHOLE * 2
+    ):
+        super().__init__()
+        self.delay = delay
+        self.feedback = feedback
+        self.mix = mix
+        self.delay_multiplier = delay_multiplier
+        self.line = DelayLine(int(max_delay))
+
+    def process_block(self, frames):
+        feedback = min(max(self.feedback.cached_value, 0.0), 0.98)
+        mix = self.mix.cached_value
+
+        x = self.input_block(frames)
+        _, delayed = self.line.process(x, self.delay.cached_value * self.delay_multiplier, feedback)
+        self.set_block((1.0 - mix) * x + mix * delayed, frames)
+
+    def reset_chain(self):
+        self.line.reset()
+        super().reset_chain()
+
+    def get_display_properties(self):
+        return 'Delay: {} s\nFeedback: {}\nMix: {}'.format(
+            self.delay.cached_value * self.delay_multiplier / SAMPLE_RATE,
+            self.feedback.cached_value,
+            self.mix.cached_value
+        )
+
+
+class ReverbNode(Node):
+    # Schroeder reverb: parallel feedback combs into series allpasses, with Freeverb's delay lengths scaled to
+    # SAMPLE_RATE.
+    COMB_DELAYS = [int(d * SAMPLE_RATE / 44100.0) for d in (1116, 1188, 1277, 1356)]
+    ALLPASS_DELAYS = [int(d * SAMPLE_RATE / 44100.0) for d in (556, 441)]
+    ALLPASS_GAIN = 0.5
+
+    def __init__(self, room_size=Parameter(0.84), mix=Parameter(0.3)):
+        super().__init__()
+        self.room_size = room_size
+        self.mix = mix
+        self.combs = [DelayLine(d) for d in ReverbNode.COMB_DELAYS]
+        self.allpasses = [DelayLine(d) for d in ReverbNode.ALLPASS_DELAYS]
+
+    def process_block(self, frames):
+        dry = self.input_block(frames)
+        feedback = min(max(self.room_size.cached_value, 0.0), 0.98)
+        mix = self.mix.cached_value
+        g = ReverbNode.ALLPASS_GAIN
+
+        wet = sum(line.process(dry, line.size, feedback)[0] for line in self.combs) / len(self.combs)
+        for line in self.allpasses:
+            v, delayed = line.process(wet, line.size, g)
+            wet = delayed - g * v
+
+        self.set_block((1.0 - mix) * dry + mix * wet, frames)
+
+    def reset_chain(self):
+        for line in self.combs + self.allpasses:
+            line.reset()
+        super().reset_chain()
+
+    def get_display_properties(self):
+        return 'Room size: {}\nMix: {}'.format(self.room_size.cached_value, self.mix.cached_value)
 
 
 class Chain:
@@ -430,67 +883,126 @@ class Chain:
 
         self.source_node = source_node
         self.termination_node = termination_node
-        self.old_termination_node = termination_node
 
         self.source_node.chain = self
         self.termination_node.chain = self
 
-        self.stream = None
+        self.mixer = None
+        self.output_mixer = None  # Where gate-triggered plays go; main_mixer when None
+        self.render_lock = threading.Lock()  # Held while a preview or benchmark renders through the chain
         self.started = False
         self.terminating = False
 
+        self.tail_frames = 0
+        self.tail_peak = 0.0
+
         self.time_elapsed = 0.0
         self.duration = duration
         self.old_duration = duration
 
         self.values = None
+        self.graph_preview = None  # (key, path) of the last laid-out graph
 
-    def play_chain(self, save_values=False):
-        if self.started:
+        self._order = []
+        self._order_version = -1
+
+    def processing_order(self):
+        # Topological order of every node reachable from the source, recomputed only when the graph changes.
+        if self._order_version != graph_version:
+            reachable = []
+            seen = {self.source_node}
+            nodes = [self.source_node]
+            while len(nodes) > 0:
+                n = nodes.pop()
+                reachable.append(n)
+                for ds in n.downstream:
+                    if ds not in seen:
+                        seen.add(ds)
+                        nodes.append(ds)
+
+            pending = {n: sum(1 for up in n.upstream if up in seen) for n in reachable}
+            order = []
+            ready = [n for n in reachable if pending[n] == 0]
+            while len(ready) > 0:
+                n = ready.pop()
+                order.append(n)
+                for ds in n.downstream:
+                    pending[ds] -= 1
+                    if pending[ds] == 0:
+                        ready.append(ds)
+
+            self._order = order
+            self._order_version = graph_version
+
+        return self._order
+
+    def render_block(self, frames):
+        for n in self.processing_order():
+            n.process_block(frames)
+
+        block = self.termination_node.block
+        if self.terminating and self.envelopes_finished():
+            self.tail_frames += frames
+            self.tail_peak = float(np.abs(block).max())
+        return block
+
+    def envelopes(self):
+        return [n for n in self.processing_order() if isinstance(n, EnvelopeNode)]
+
+    def gate_envelopes(self, gate):
+        for n in self.envelopes():
+            if gate:
+                n.gate_on()
+            else:
+                n.gate_off()
+
+    def envelopes_finished(self):
+        return all(n.finished for n in self.envelopes())
+
+    def tail_finished(self):
+        return self.tail_frames > 0 and (self.tail_peak < TAIL_THRESHOLD or self.tail_frames >= MAX_TAIL)
+
+    def play_chain(self, save_values=False, mixer=None):
+        if not save_values and mixer is None and self.output_mixer is None:
+            # Live triggers take render_lock too, so they can't start the chain while a preview is rendering it.
+            if not self.render_lock.acquire(blocking=False):
+                return
+            try:
+                return self.play_chain(mixer=main_mixer)
+            finally:
+                self.render_lock.release()
+
+        if self.started and self.terminating:
+            # Re-triggered while releasing: the envelopes attack again from their current level.
+            self.terminating = False
+            self.tail_frames = 0
+            self.tail_peak = 0.0
+            self.gate_envelopes(True)
             return
 
-        import pyaudio
-        p = pyaudio.PyAudio()
+        if self.started:
+            return
 
-        sn = self.source_node
+        self.gate_envelopes(True)
 
         if save_values:
-            self.values = []
-
-        def run_chain(nodes):
-            while len(nodes) > 0:
-                new_nodes = []
-                for n in nodes:
-                    n.step()
-                    new_nodes.extend(n.downstream)
-                nodes = list(set(new_nodes))
-
-        def callback(_in_data, _frame_count, _time_info, _status):
-            output_samples = []
-
-            for _ in cached_repeat:
-                run_chain([sn])
-                output_samples.append(self.termination_node.value)
+            blocks = []
+            for i in range(0, int(self.duration), FRAME_SIZE):
+                frames = min(FRAME_SIZE, int(self.duration) - i)
+                self.time_elapsed += frames
+                blocks.append(self.render_block(frames).copy())
 
-            return np.array(output_samples, dtype=np.float32) * VOLUME, pyaudio.paContinue
+            if len(self.envelopes()) > 0:
+                self.terminating = True
+                self.gate_envelopes(False)
+                while not self.tail_finished():
+                    blocks.append(self.render_block(FRAME_SIZE).copy())
 
-        if save_values:
-            for i in range(int(self.duration)):
-                self.time_elapsed += 1
-                run_chain([sn])
-                self.values.append(self.termination_node.value)
-
-            if self.termination_node.release_chain is not None:
-                print('test')
-                tn = self.termination_node
-                self.stop_chain()
-                for i in range(int(tn.release_chain.duration)):
-                    run_chain([sn])
-                    self.values.append(self.termination_node.value)
+            self.values = np.concatenate(blocks) if len(blocks) > 0 else np.zeros(0, dtype=np.float32)
 
         else:
-            self.stream = p.open(format=pyaudio.paFloat32, channels=1, rate=int(SAMPLE_RATE), output=True,
-                                 frames_per_buffer=FRAME_SIZE, stream_callback=callback)
+            self.mixer = mixer or self.output_mixer or main_mixer
+            self.mixer.add_chain(self)
 
         self.started = True
 
@@ -502,92 +1014,167 @@ class Chain:
             if self.time_elapsed < self.duration:
                 return
 
-        if (self.termination_node.release_chain is not None and self.termination_node.release_chain.duration >= 0.0
-                and not self.terminating):
-            self.terminating = True
-
-            self.termination_node.release_chain.source_node.register_upstream(self.termination_node)
-            duration = self.termination_node.release_chain.duration
-            self.termination_node = self.termination_node.release_chain.termination_node
-
-            self.old_duration = self.duration
-            self.duration = (self.duration if self.duration > 0 else 0) + duration
-
+        if self.terminating:
             return
 
-        if self.stream is not None:
-            self.stream.stop_stream()
-            self.stream.close()
-            self.stream = None
+        if len(self.envelopes()) > 0:
+            # The envelopes release on the audio thread; tick() ends the chain once they have finished and the tail
+            # behind them has died away.
+            self.tail_frames = 0
+            self.tail_peak = 0.0
+            self.terminating = True
+            self.gate_envelopes(False)
+            return
 
-        self.termination_node = self.old_termination_node
+        self.end_chain()
 
-        if self.termination_node.release_chain is not None:
-            self.termination_node.release_chain.source_node.unregister_upstream(self.termination_node)
-            self.termination_node.release_chain.reset_chain()
+    def end_chain(self):
+        if self.mixer is not None:
+            self.mixer.remove_chain(self)
+            self.mixer = None
 
         self.reset_chain()
 
     def reset_chain(self):
         self.started = False
         self.terminating = False
+        self.tail_frames = 0
+        self.tail_peak = 0.0
         self.time_elapsed = 0.0
         self.duration = self.old_duration
         self.source_node.reset_chain()
 
     def visualize_chain(self):
-        import matplotlib.pyplot as plt
-        import matplotlib.image as mpimg
-
         def node_id(node):
             return type(node).__name__ + '\n' + str(id(node)) + '\n' + node.get_display_properties()
 
-        graph = pgv.AGraph(strict=False, directed=True)
+        labels = []
+        edges = []
         nodes = [self.source_node]
         while len(nodes) > 0:
             new_nodes = []
             for n in nodes:
-                graph.add_node(node_id(n))
+                labels.append(node_id(n))
                 for nd in n.downstream:
-                    graph.add_edge(node_id(n), node_id(nd))
+                    edges.append((node_id(n), node_id(nd)))
                 new_nodes.extend(n.downstream)
-            if nodes[0] == self.termination_node:
-                if self.termination_node.release_chain is not None:
-                    new_nodes = [self.termination_node.release_chain.source_node]
-                    graph.add_edge(
-                        node_id(self.termination_node),
-                        node_id(self.termination_node.release_chain.source_node)
-                    )
-                    e = graph.get_edge(
-                        node_id(self.termination_node),
-                        node_id(self.termination_node.release_chain.source_node)
-                    )
-                    e.attr['color'] = 'turquoise'
             nodes = list(set(new_nodes))
-        graph.layout(prog='dot')
-        graph.draw('temp.png')
-        img = mpimg.imread('temp.png')
-        plt.imshow(img, interpolation='bicubic')
-        plt.show()
 
-    def chain_playviz(self, new_duration):
-        import matplotlib.pyplot as plt
-        import matplotlib.image as mpimg
+        # Labels show live parameter values, so they are part of the key along with the graph's shape.
+        key = (graph_version, tuple(labels), tuple(edges))
+        if self.graph_preview is not None and self.graph_preview[0] == key:
+            preview_worker.submit(lambda path: path, self.graph_preview[1])
+            return
 
-        old_duration = self.duration
-        self.duration = new_duration
-        values = self.play_chain(save_values=True)
-        self.duration = old_duration
+        graph = pgv.AGraph(strict=False, directed=True)
+        for label in labels:
+            graph.add_node(label)
+        for edge in edges:
+            graph.add_edge(*edge)
+
+        def layout():
+            path = draw_graph(graph, temp_preview_path('.svg'))
+            if self.graph_preview is not None:
+                try:
+                    os.remove(self.graph_preview[1])
+                except OSError:
+                    pass
+            self.graph_preview = (key, path)
+            return path
+
+        preview_worker.submit(layout)
 
-        plt.plot(range(len(values)), values, 'b-')
-        plt.show()
+    def chain_playviz(self, new_duration):
+        def render():
+            if not self.render_lock.acquire(blocking=False):
+                print('Chain is busy; preview skipped.')
+                return None
+            if self.started:
+                self.render_lock.release()
+                print('Chain is playing; preview skipped.')
+                return None
+
+            old_duration = self.duration
+            self.duration = new_duration
+            try:
+                values = self.play_chain(save_values=True)
+            finally:
+                # The preview renders through the chain itself, so it must always be torn down again afterwards.
+                self.end_chain()
+                self.duration = old_duration
+                self.old_duration = old_duration
+                self.render_lock.release()
+
+            return draw_waveform(values, SAMPLE_RATE, temp_preview_path('.png'))
+
+        preview_worker.submit(render)
+
+    def benchmark_chain(self, seconds):
+        if not self.render_lock.acquire(blocking=False):
+            return None
+        if self.started or not isinstance(self.source_node, ChainStartNode):
+            self.render_lock.release()
+            return None
+
+        # Runs the whole real-time path into a null sink as fast as possible. Before each block, the watcher ticks
+        # due by then (64 per second of audio) are dispatched on the render thread, and this chain's gate is toggled
+        # every half second of audio so that gate scheduling and envelope releases are exercised too.
+        mixer = Mixer(NullBackend(realtime=False))
+        gate = Parameter(0.0)
+        start_param = self.source_node.start_param
+        self.source_node.start_param = gate
+        self.output_mixer = mixer
+
+        watchers = [w for w in global_watchers if isinstance(w, Parameter)] + [self.source_node, self]
+        ticks_per_block = 64.0 * FRAME_SIZE / SAMPLE_RATE
+        stats = {'blocks': 0, 'ticks': 0, 'dispatch_time': 0.0}
+
+        def render_block():
+            dispatch_start = time.perf_counter()
+            stats['blocks'] += 1
+            while stats['ticks'] < stats['blocks'] * ticks_per_block:
+                if stats['ticks'] % 32 == 0:
+                    gate.param_value = 0.0 if gate.param_value >= self.source_node.gate else 1.0
+                for w in watchers:
+                    w.tick()
+                stats['ticks'] += 1
+            stats['dispatch_time'] += time.perf_counter() - dispatch_start
+            return mixer.render_block()
+
+        try:
+            mixer.stream = mixer.backend.open_stream(render_block, SAMPLE_RATE, channels=mixer.channels,
+                                                     frames_per_buffer=FRAME_SIZE)
+            start = time.perf_counter()
+            time.sleep(seconds)
+            mixer.close()
+            elapsed = time.perf_counter() - start
+        finally:
+            self.end_chain()
+            self.source_node.start_param = start_param
+            self.output_mixer = None
+            self.render_lock.release()
+
+        blocks = mixer.stream.blocks
+        if blocks == 0:
+            return None
+
+        return {
+            'blocks': blocks,
+            'ticks': stats['ticks'],
+            'realtime_factor': (blocks * FRAME_SIZE / SAMPLE_RATE) / elapsed,
+            'render_ms_per_block': (mixer.stream.render_time - stats['dispatch_time']) / blocks * 1000.0,
+            'dispatch_ms_per_tick': stats['dispatch_time'] / max(stats['ticks'], 1) * 1000.0,
+        }
 
     def tick(self):
-        if self.started and self.duration >= 0:
+        if self.started and self.duration >= 0 and not self.terminating:
             self.time_elapsed += 1.0/64.0 * SAMPLE_RATE
             if self.time_elapsed > self.duration:
                 self.stop_chain()
 
+        if self.terminating and self.tail_finished():
+            self.end_chain()
+
     def set_duration(self, duration):
         self.old_duration = duration  # Not used the way it would imply here
         self.duration = duration
@@ -609,21 +1196,47 @@ class Chain:
         return Chain(nodes[0], nodes[-1])
 
 
-forth_decay = Chain.build_linear(
-    LinearDecayNode(duration=BEAT_4TH),
-    ChainTerminationNode()
-).set_duration(BEAT_4TH)
+class Mixer:
+    def __init__(self, backend, channels=OUTPUT_CHANNELS):
+        self.backend = backend
+        self.channels = channels
+        self.volume = VOLUME
+        self.chains = []
+        self.stream = None
+        self.output = np.zeros((FRAME_SIZE, channels), dtype=np.float32)
+
+    def add_chain(self, chain):
+        # The list is replaced rather than mutated so the audio thread always iterates a consistent snapshot.
+        if chain not in self.chains:
+            self.chains = self.chains + [chain]
+
+        if self.stream is None:
+            self.stream = self.backend.open_stream(self.render_block, SAMPLE_RATE, channels=self.channels,
+                                                   frames_per_buffer=FRAME_SIZE)
+
+    def remove_chain(self, chain):
+        self.chains = [c for c in self.chains if c is not chain]
 
+    def render_block(self):
+        # Mono chain blocks are panned straight into one interleaved (frames, channels) buffer, which the backend
+        # hands to PortAudio as-is; it is reused across callbacks.
+        output = self.output
+        output.fill(0.0)
 
-eighth_decay = Chain.build_linear(
-    LinearDecayNode(duration=BEAT_8TH),
-    ChainTerminationNode()
-).set_duration(BEAT_8TH)
+        for chain in self.chains:
+            tn = chain.termination_node
+            block = chain.render_block(FRAME_SIZE)
+            output[:, OUTPUT_BUSES[tn.bus]] += block[:, np.newaxis] * (tn.output_gains * self.volume)
 
-whole_decay = Chain.build_linear(
-    LinearDecayNode(duration=BEAT_WHOLE),
-    ChainTerminationNode()
-).set_duration(BEAT_WHOLE)
+        return output
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.stop_stream()
+            self.stream.close()
+
+
+main_mixer = Mixer(output_backend)
 
 
 button_7 = Parameter(7)
@@ -631,9 +1244,11 @@ button_7_start = ChainStartNode(button_7)
 button_7_source1 = SineNode(frequency=Parameter(49.99)).register_upstream(button_7_start)
 button_7_source2 = SineNode(frequency=Parameter(97.99)).register_upstream(button_7_start)
 button_7_source3 = SawtoothNode(frequency=Parameter(146.83)).register_upstream(button_7_start)
-button_7_out = ChainTerminationNode(release_chain=eighth_decay).register_upstream(button_7_source1)\
+button_7_envelope = ADSRNode(attack=0.0, decay=0.0, sustain=1.0, release=BEAT_8TH)\
+    .register_upstream(button_7_source1)\
     .register_upstream(button_7_source2)\
     .register_upstream(button_7_source3)
+button_7_out = ChainTerminationNode().register_upstream(button_7_envelope)
 button_7_chain = Chain(button_7_start, button_7_out)
 
 button_6 = Parameter(6)
@@ -641,8 +1256,9 @@ button_6_start = ChainStartNode(button_6)
 # button_6_source = SineNode(frequency=Parameter(123.47)).register_upstream(button_6_start)
 button_6_source = SineNode(frequency=Parameter(8), frequency_offset=110.0, frequency_multiplier=600.0)\
     .register_upstream(button_6_start)
-button_6_attack = LinearAttackNode(duration=BEAT_WHOLE).register_upstream(button_6_source)
-button_6_out = ChainTerminationNode(release_chain=whole_decay).register_upstream(button_6_attack)
+button_6_envelope = ADSRNode(attack=BEAT_WHOLE, decay=0.0, sustain=1.0, release=BEAT_WHOLE)\
+    .register_upstream(button_6_source)
+button_6_out = ChainTerminationNode().register_upstream(button_6_envelope)
 button_6_chain = Chain(button_6_start, button_6_out)
 
 button_5 = Parameter(5)
@@ -671,6 +1287,15 @@ hi_hat_chain = Chain(hi_hat_start, hi_hat_out)
 
 
 button_2 = Parameter(2)
+button_2_start = ChainStartNode(button_2)
+button_2_source = SawtoothNode(frequency=Parameter(110.0)).register_upstream(button_2_start)
+button_2_filter = BiquadFilterNode(cutoff=Parameter(POTENTIOMETER), cutoff_offset=200.0, cutoff_multiplier=4000.0)\
+    .register_upstream(button_2_source)
+button_2_envelope = ADSRNode(release=BEAT_4TH, curve=EnvelopeNode.EXPONENTIAL).register_upstream(button_2_filter)
+button_2_delay = DelayNode(delay=Parameter(BEAT_8TH), feedback=Parameter(0.4)).register_upstream(button_2_envelope)
+button_2_reverb = ReverbNode().register_upstream(button_2_delay)
+button_2_out = ChainTerminationNode().register_upstream(button_2_reverb)
+button_2_chain = Chain(button_2_start, button_2_out)
 
 button_1 = Parameter(1)
 
@@ -679,10 +1304,12 @@ def event_handler(sl, qt):
     global global_watchers
     global inputs
     inputs = sl
+    sample_library.prefetcher.start()  # Audio renders in this process, so its sample prefetching has to run here
     while not qt.value:
         for w in global_watchers:
             w.tick()
         time.sleep(1.0/64.0)
+    main_mixer.close()
 
 
 aliases = {
@@ -690,13 +1317,22 @@ aliases = {
     'Sine': SineNode,
     'Triangle': TriangleNode,
     'Square': SquareNode,
-    'Sawtooth': SawtoothNode
+    'Sawtooth': SawtoothNode,
+    'Biquad': BiquadFilterNode,
+    'Delay': DelayNode,
+    'Reverb': ReverbNode,
+    'Sample': SampleNode
 }
 
 
 t = multiprocessing.Process(target=event_handler, args=(shared_list, quit_threads))
 t2 = multiprocessing.Process(target=input_monitor, args=(shared_list, quit_threads))
-t3 = multiprocessing.Process()
+if OSC_ADDRESS != 'off':
+    osc_host, _, osc_port = OSC_ADDRESS.rpartition(':')
+    t3 = multiprocessing.Process(target=osc_monitor, args=(shared_list, quit_threads, control_slots, osc_host,
+                                                           int(osc_port), FRAME_SIZE / SAMPLE_RATE))
+else:
+    t3 = multiprocessing.Process()
 t.start()
 t2.start()
 t3.start()
@@ -705,6 +1341,7 @@ command = ""
 
 show_re = "show\s+(?P<chain>\w+)"
 wave_re = "wave\s+(?P<dur>[0-9\.]+)\s+(?P<chain>\w+)"
+bench_re = "bench\s+(?P<dur>[0-9\.]+)\s+(?P<chain>\w+)"
 
 while command not in ["quit", "exit"]:
     command = input("patch-cable > ")
@@ -723,8 +1360,22 @@ while command not in ["quit", "exit"]:
             eval('{}.chain_playviz({})'.format(m['chain'], float(m['dur']) * SAMPLE_RATE))
         except NameError:
             print('Bad chain name.')
+    elif re.match(bench_re, command):
+        m = re.match(bench_re, command).groupdict()
+        try:
+            stats = eval('{}.benchmark_chain({})'.format(m['chain'], float(m['dur'])))
+        except NameError:
+            print('Bad chain name.')
+            continue
+        if stats is None:
+            print('Chain is playing or rendering a preview.')
+        else:
+            print('{} blocks, {} ticks, {:.2f}x real time; render {:.3f} ms/block, dispatch {:.3f} ms/tick'.format(
+                stats['blocks'], stats['ticks'], stats['realtime_factor'], stats['render_ms_per_block'],
+                stats['dispatch_ms_per_tick']))
 
 quit_threads.value = 1
 
+t3.join()
 t2.join()
 t.join()
@@ -0,0 +1,253 @@
+import hashlib
+import math
+import os
+import queue
+import threading
+import time
+
+from fractions import Fraction
+
+import numpy as np
+
+from scipy.io import wavfile
+from scipy.signal import resample_poly
+
+
+RESAMPLE_CHUNK = 1 << 16  # Input frames resampled at a time while building a cache entry
+PREFETCH_REPORT_INTERVAL = 1.0
+
+
+def wav_scale(dtype):
+    if dtype == np.uint8:
+        return 1.0 / 128.0, 128.0
+    elif np.issubdtype(dtype, np.integer):
+        return 1.0 / float(np.iinfo(dtype).max + 1), 0.0
+    return 1.0, 0.0
+
+
+def read_wav(path):
+    try:
+        return wavfile.read(path, mmap=True)
+    except ValueError:
+        # scipy can't memory-map every encoding (e.g. 24-bit PCM), so those few are read normally.
+        return wavfile.read(path)
+
+
+def build_cache_entry(path, cache_path, sample_rate):
+    rate, data = read_wav(path)
+    scale, offset = wav_scale(data.dtype)
+
+    ratio = Fraction(int(sample_rate), int(rate))
+    up, down = ratio.numerator, ratio.denominator
+
+    # Chunks and their padding are multiples of `down`, so each chunk's output lines up exactly with the output of
+    # resampling the whole file, and the padding covers resample_poly's filter (10 * max(up, down) taps per side at
+    # the upsampled rate).
+    pad = down * int(math.ceil((10 * max(up, down) / float(up) + 1) / down))
+    chunk = down * max(1, RESAMPLE_CHUNK // down)
+
+    frames_in = len(data)
+    frames_out = int(math.ceil(frames_in * up / float(down)))
+
+    tmp_path = cache_path + '.tmp'
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(frames_out,))
+
+    for start in range(0, frames_in, chunk):
+        lo = max(start - pad, 0)
+        hi = min(start + chunk + pad, frames_in)
+
+        x = (np.asarray(data[lo:hi], dtype=np.float64) - offset) * scale
+        if x.ndim > 1:
+            x = x.mean(axis=1)
+
+        y = resample_poly(x, up, down) if up != down else x
+        out_start = start * up // down
+        out_end = min((start + chunk) * up // down, frames_out)
+        out[out_start:out_end] = y[out_start - lo * up // down:out_end - lo * up // down]
+
+    out.flush()
+    del out
+    os.replace(tmp_path, cache_path)
+
+
+class SamplePrefetcher:
+    # Copies upcoming regions of memory-mapped samples into memory ahead of the voices playing them, so that the audio
+    # thread only ever reads resident data. Threads don't survive a fork, so the worker is started lazily by (and
+    # belongs to) whichever process renders audio.
+    def __init__(self, max_pending=256):
+        self.max_pending = max_pending
+        self.pid = None
+        self.requests = None
+        self.thread = None
+
+        self.dropped = 0  # Requests that didn't fit in the queue
+        self.misses = 0  # Blocks the audio thread had to read from the memory map
+        self.last_report = time.monotonic()
+
+    def start(self):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.requests = queue.Queue(maxsize=self.max_pending)
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def request(self, sample, chunk):
+        self.start()
+        try:
+            self.requests.put_nowait((sample, chunk))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def report(self):
+        if (self.dropped > 0 or self.misses > 0) and time.monotonic() - self.last_report >= PREFETCH_REPORT_INTERVAL:
+            print('Sample prefetch: dropped {} requests, read {} blocks from disk'.format(self.dropped, self.misses))
+            self.dropped = 0
+            self.misses = 0
+            self.last_report = time.monotonic()
+
+    def _run(self):
+        requests = self.requests
+        while True:
+            try:
+                sample, chunk = requests.get(timeout=PREFETCH_REPORT_INTERVAL)
+                sample.load_chunk(chunk)
+            except queue.Empty:
+                pass
+            self.report()
+
+
+class Sample:
+    def __init__(self, name, data, prefetcher, stream_chunk, preload_chunks=2):
+        self.name = name
+        self.data = data
+        self.prefetcher = prefetcher
+        self.stream_chunk = stream_chunk
+        self.preload_chunks = preload_chunks
+        self.chunk_count = (len(data) + stream_chunk - 1) // stream_chunk
+        self.voices = 0
+
+        # Resident copies of chunks: the first few are kept for good so that hits start without I/O; the rest are
+        # filled in by the prefetcher. Each voice holds the chunk it is playing and the ones it will play next, and a
+        # held chunk is never dropped. The audio thread only ever reads these dicts.
+        self.pinned = dict((c, np.array(data[c * stream_chunk:(c + 1) * stream_chunk]))
+                           for c in range(preload_chunks))
+        self.streamed = {}
+        self.holds = {}  # chunk: number of voices holding it
+        self.requested = set()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def add_voice(self):
+        self.voices += 1
+
+    @property
+    def max_streamed_chunks(self):
+        # Enough for every voice's window; chunks no voice holds are dropped oldest-first beyond that.
+        return max(self.voices, 1) * (self.preload_chunks + 1)
+
+    def window(self, position):
+        chunk = position // self.stream_chunk
+        return range(chunk, min(chunk + self.preload_chunks + 1, self.chunk_count))
+
+    def resident(self, chunk):
+        return chunk in self.pinned or chunk in self.streamed
+
+    def acquire(self, position):
+        # Called by a voice as it enters a new chunk; holds that chunk and the window after it, and asks for any of
+        # them that aren't resident yet.
+        missing = []
+        with self.lock:
+            for chunk in self.window(position):
+                self.holds[chunk] = self.holds.get(chunk, 0) + 1
+                if not self.resident(chunk) and chunk not in self.requested:
+                    missing.append(chunk)
+                    self.requested.add(chunk)
+
+        for chunk in missing:
+            if not self.prefetcher.request(self, chunk):
+                self.requested.discard(chunk)
+
+    def release(self, position):
+        with self.lock:
+            for chunk in self.window(position):
+                if self.holds[chunk] > 1:
+                    self.holds[chunk] -= 1
+                else:
+                    del self.holds[chunk]
+
+    def load_chunk(self, chunk):
+        if self.resident(chunk) or chunk not in self.holds:
+            self.requested.discard(chunk)
+            return
+
+        data = np.array(self.data[chunk * self.stream_chunk:(chunk + 1) * self.stream_chunk])
+        with self.lock:
+            self.streamed[chunk] = data
+            self.requested.discard(chunk)
+
+            excess = len(self.streamed) - self.max_streamed_chunks
+            if excess > 0:
+                for c in [c for c in self.streamed if c not in self.holds][:excess]:
+                    del self.streamed[c]
+
+    def frames(self, start, count):
+        # Views of resident chunks, shared by every voice playing this sample; a block straddling two chunks is joined
+        # from both. Only a chunk that isn't resident yet falls back to the memory map, and that is counted.
+        end = min(start + count, len(self.data))
+        if end <= start:
+            return np.zeros(0, dtype=np.float32)
+
+        parts = []
+        for chunk in range(start // self.stream_chunk, (end - 1) // self.stream_chunk + 1):
+            resident = self.pinned.get(chunk)
+            if resident is None:
+                resident = self.streamed.get(chunk)
+            if resident is None:
+                self.prefetcher.misses += 1
+                return self.data[start:end]
+
+            offset = chunk * self.stream_chunk
+            parts.append(resident[max(start - offset, 0):end - offset])
+
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+
+class SampleLibrary:
+    def __init__(self, cache_directory, sample_rate, stream_chunk):
+        self.cache_directory = cache_directory
+        self.sample_rate = sample_rate
+        self.stream_chunk = stream_chunk
+        self.samples = {}
+        self.prefetcher = SamplePrefetcher()
+
+    def cache_path(self, path):
+        stat = os.stat(path)
+        key = '{}|{}|{}|{}'.format(os.path.abspath(path), stat.st_mtime_ns, stat.st_size, self.sample_rate)
+        return os.path.join(self.cache_directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npy')
+
+    def load(self, path, name=None):
+        name = name or os.path.splitext(os.path.basename(path))[0]
+        if name in self.samples:
+            return self.samples[name]
+
+        os.makedirs(self.cache_directory, exist_ok=True)
+        cache_path = self.cache_path(path)
+        if not os.path.exists(cache_path):
+            build_cache_entry(path, cache_path, self.sample_rate)
+
+        sample = Sample(name, np.load(cache_path, mmap_mode='r'), self.prefetcher, self.stream_chunk)
+        self.samples[name] = sample
+        return sample
+
+    def load_directory(self, directory):
+        for file_name in sorted(os.listdir(directory)):
+            if file_name.lower().endswith('.wav'):
+                self.load(os.path.join(directory, file_name))
+        return self
+
+    def __getitem__(self, name):
+        return self.samples[name]
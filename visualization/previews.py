@@ -0,0 +1,73 @@
+import os
+import queue
+import tempfile
+import threading
+import webbrowser
+
+import numpy as np
+
+
+ENVELOPE_BUCKETS = 2048
+
+
+def temp_preview_path(suffix):
+    fd, path = tempfile.mkstemp(prefix='patch-cable-', suffix=suffix)
+    os.close(fd)
+    return path
+
+
+def minmax_envelope(values, buckets=ENVELOPE_BUCKETS):
+    # Reduces a render of any length to at most `buckets` (min, max) pairs, so plotting cost stays constant.
+    values = np.asarray(values, dtype=np.float32)
+    if len(values) <= buckets:
+        return np.arange(len(values)), values, values
+
+    starts = np.linspace(0, len(values), buckets + 1, dtype=int)[:-1]
+    return starts, np.minimum.reduceat(values, starts), np.maximum.reduceat(values, starts)
+
+
+def draw_graph(graph, path):
+    graph.layout(prog='dot')
+    graph.draw(path, format='svg')
+    return path
+
+
+def draw_waveform(values, sample_rate, path):
+    # Uses the Agg canvas directly rather than pyplot so that drawing is safe off the main thread and never blocks.
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    x, lower, upper = minmax_envelope(values)
+
+    figure = Figure(figsize=(10, 4))
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot(1, 1, 1)
+    axes.fill_between(x / sample_rate, lower, upper, color='b', linewidth=0.5)
+    axes.set_xlabel('Time (s)')
+    figure.savefig(path)
+    return path
+
+
+class PreviewWorker:
+    def __init__(self, open_previews=True):
+        self.open_previews = open_previews
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, fn, *args):
+        self.jobs.put((fn, args))
+
+    def _run(self):
+        while True:
+            fn, args = self.jobs.get()
+            try:
+                path = fn(*args)
+            except Exception as e:
+                print('Preview failed: {}'.format(e))
+                continue
+
+            if path is not None:
+                print('Preview written to {}'.format(path))
+                if self.open_previews:
+                    webbrowser.open('file://' + os.path.abspath(path))